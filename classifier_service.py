@@ -1,13 +1,16 @@
-import os
-import requests
+import asyncio
+import hashlib
+import aiohttp
+import orjson
 import logging
 import time
+from cachetools import TTLCache
+from settings import get_settings
 from tenacity import retry, stop_after_attempt, wait_exponential, before_log, after_log
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-HF_API_URL = os.getenv("MODEL_ENDPOINT")
 DOCUMENT_TYPES = [
     "ultrasound report",
     "blood test results",
@@ -15,14 +18,138 @@ DOCUMENT_TYPES = [
     "prenatal screening"
 ]
 
+# Request parameters are identical for every call, so build them once
+_LABELS_STR = ", ".join(DOCUMENT_TYPES)
+_BASE_PARAMS = {"candidate_labels": _LABELS_STR}
+
+# Cache of classifications keyed on a hash of the (limited) text, created on startup
+_cache: TTLCache | None = None
+# In-flight classifications, so concurrent duplicate texts share a single HF call
+_inflight: dict[bytes, asyncio.Future] = {}
+
+# Micro-batching: coalesce up to MAX_BATCH texts, waiting at most MAX_DELAY seconds
+MAX_BATCH = 8
+MAX_DELAY = 0.05
+# Batches sent to HF concurrently; well under the session's 64-connection pool
+MAX_CONCURRENT_BATCHES = 8
+
+# Shared HTTP session, opened on app startup so the TCP+TLS pool is reused
+_session: aiohttp.ClientSession | None = None
+
+async def open_session():
+    """Create the shared aiohttp session used for Hugging Face calls"""
+    global _session
+    if _session is None or _session.closed:
+        # Headers only depend on the token, so they are set once on the session
+        token = get_settings().hf_token
+        _session = aiohttp.ClientSession(
+            headers={
+                "Accept": "application/json",
+                "Authorization": f"Bearer {token}",
+                "Content-Type": "application/json"
+            },
+            connector=aiohttp.TCPConnector(limit=64, keepalive_timeout=75),
+            timeout=aiohttp.ClientTimeout(total=30)
+        )
+
+async def close_session():
+    """Close the shared aiohttp session"""
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+_batch_queue: asyncio.Queue | None = None
+_batch_task: asyncio.Task | None = None
+# Strong references to in-flight batch requests so they aren't garbage collected
+_batch_requests: set[asyncio.Task] = set()
+
+def start_batch_worker():
+    """Create the result cache and start the background task that batches classify calls"""
+    global _batch_queue, _batch_task, _cache
+    if _batch_task is None or _batch_task.done():
+        _cache = TTLCache(maxsize=1024, ttl=get_settings().cache_ttl)
+        _batch_queue = asyncio.Queue()
+        _batch_task = asyncio.create_task(batch_worker())
+
+async def stop_batch_worker():
+    """Cancel the batch worker and wait for it to exit"""
+    global _batch_task
+    if _batch_task is not None:
+        _batch_task.cancel()
+        try:
+            await _batch_task
+        except asyncio.CancelledError:
+            pass
+        _batch_task = None
+    for task in list(_batch_requests):
+        task.cancel()
+    await asyncio.gather(*_batch_requests, return_exceptions=True)
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling HF while the circuit breaker is open"""
+
+class CircuitBreaker:
+    """Track HF endpoint health across requests and fail fast while it is down"""
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 3, base_backoff: float = 0.5, max_backoff: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.backoff = base_backoff
+        self.probe_in_flight = False
+
+    def allow_request(self) -> bool:
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.backoff:
+                return False
+            # Backoff elapsed, let exactly one caller probe the endpoint
+            self.state = self.HALF_OPEN
+            self.probe_in_flight = True
+            logger.info("Circuit breaker half-open, probing HF API")
+            return True
+        if self.state == self.HALF_OPEN:
+            # Everyone else keeps failing fast until the probe comes back
+            return False
+        return True
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info("Circuit breaker closed, HF API recovered")
+        self.state = self.CLOSED
+        self.probe_in_flight = False
+        self.failures = 0
+        self.backoff = self.base_backoff
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN:
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            self._open()
+        elif self.state == self.CLOSED and self.failures >= self.failure_threshold:
+            self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self.probe_in_flight = False
+        self.opened_at = time.monotonic()
+        logger.warning(f"Circuit breaker open, failing fast for {self.backoff}s")
+
+_breaker = CircuitBreaker()
+
 # Custom retry strategy: Don't retry on 503 Service Unavailable
 def should_retry_exception(exception):
-    if isinstance(exception, requests.exceptions.RequestException):
+    if isinstance(exception, aiohttp.ClientResponseError):
         # If it's a 503 error, don't retry
-        if hasattr(exception, 'response') and exception.response is not None:
-            if exception.response.status_code == 503:
-                logger.warning("Received 503 Service Unavailable, not retrying")
-                return False
+        if exception.status == 503:
+            logger.warning("Received 503 Service Unavailable, not retrying")
+            return False
     return True
 
 @retry(
@@ -32,84 +159,175 @@ def should_retry_exception(exception):
     after=after_log(logger, logging.INFO)
 )
 
-async def classify_document(text: str) -> dict:
-    """Classify document using Hugging Face API"""
-    if not HF_API_URL:
-        logger.error("MODEL_ENDPOINT environment variable is not set")
-        raise RuntimeError("HF API URL not configured")
-        
-    token = os.getenv('HF_API_TOKEN')
-    if not token:
-        logger.error("HF_API_TOKEN environment variable is not set")
-        raise RuntimeError("HF API token not configured")
-        
-    headers = {
-        "Accept": "application/json",
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-    
+async def _post_batch(texts: list[str]) -> list:
+    """Send a batch of texts to the Hugging Face API in a single request"""
+    settings = get_settings()
+    url = settings.model_endpoint
     try:
-        logger.info(f"Sending request to Hugging Face API at {HF_API_URL}")
-        logger.info(f"Text length: {len(text)} characters")
-        
-        # Limit text size to prevent issues with large documents
-        limited_text = text[:5000] if len(text) > 5000 else text
-        
-        # Format the payload exactly as shown in the example
-        payload = {
-            "inputs": limited_text,
-            "parameters": {
-                "candidate_labels": ", ".join(DOCUMENT_TYPES)
-            }
-        }
+        logger.info(f"Sending batch of {len(texts)} to Hugging Face API at {url}")
         
-        # Use synchronous requests for now
-        response = requests.post(
-            HF_API_URL,
-            headers=headers,
-            json=payload,
-            timeout=30  # Increase timeout
-        )
+        # Format the payload exactly as shown in the example, with a list of inputs
+        payload = {"inputs": texts, "parameters": _BASE_PARAMS}
         
-        if response.status_code == 503:
-            logger.error(f"HF API returned status code 503: {response.text}")
-            # For 503 errors, directly raise to avoid retries
-            raise RuntimeError(f"Hugging Face API is currently unavailable (503): {response.text}")
-        elif response.status_code != 200:
-            logger.error(f"HF API returned status code {response.status_code}: {response.text}")
-            response.raise_for_status()
-            
-        result = response.json()
+        async with _session.post(
+            url, data=orjson.dumps(payload), compress="gzip" if settings.compress_requests else None
+        ) as response:
+            if response.status == 503:
+                body = await response.text()
+                logger.error(f"HF API returned status code 503: {body}")
+                # For 503 errors, directly raise to avoid retries
+                raise RuntimeError(f"Hugging Face API is currently unavailable (503): {body}")
+            elif response.status != 200:
+                body = await response.text()
+                logger.error(f"HF API returned status code {response.status}: {body}")
+                response.raise_for_status()
+
+            result = orjson.loads(await response.read())
         logger.info(f"API response received successfully")
         
-        # Handle the response according to the API's actual response format
-        try:
-            # Get the highest scoring label
-            top_label_index = 0
-            if 'scores' in result and len(result['scores']) > 0:
-                top_label_index = result['scores'].index(max(result['scores']))
-                
-            return {
-                "label": result['labels'][top_label_index] if 'labels' in result else DOCUMENT_TYPES[0],
-                "confidence": round(result['scores'][top_label_index], 4) if 'scores' in result else 0.0,
-                "status": "success"
-            }
-        except (KeyError, IndexError) as e:
-            logger.error(f"Failed to parse API response: {str(e)}")
-            logger.error(f"Response content: {result}")
-            return {
-                "label": "unknown document", 
-                "confidence": 0.0,
-                "status": "parse_error",
-                "error": str(e)
-            }
+        # A single input may come back as a bare object instead of a list
+        return result if isinstance(result, list) else [result]
             
-    except requests.exceptions.RequestException as e:
-        if hasattr(e, 'response') and e.response is not None and e.response.status_code == 503:
+    except aiohttp.ClientError as e:
+        if isinstance(e, aiohttp.ClientResponseError) and e.status == 503:
             logger.error(f"HF API unavailable (503): {str(e)}")
             # Don't retry 503 errors
             raise RuntimeError(f"Hugging Face API is currently unavailable (503): {str(e)}")
         else:
             logger.error(f"HF API request failed: {str(e)}")
-            raise
\ No newline at end of file
+            raise
+
+def _parse_result(result) -> dict:
+    """Turn one zero-shot response into a classification dict"""
+    # Handle the response according to the API's actual response format
+    try:
+        # Get the highest scoring label
+        top_label_index = 0
+        if 'scores' in result and len(result['scores']) > 0:
+            scores = result['scores']
+            top_label_index = max(range(len(scores)), key=scores.__getitem__)
+            
+        return {
+            "label": result['labels'][top_label_index] if 'labels' in result else DOCUMENT_TYPES[0],
+            "confidence": round(result['scores'][top_label_index], 4) if 'scores' in result else 0.0,
+            "status": "success"
+        }
+    except (KeyError, IndexError, TypeError) as e:
+        logger.error(f"Failed to parse API response: {str(e)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Response content: {result}")
+        return {
+            "label": "unknown document", 
+            "confidence": 0.0,
+            "status": "parse_error",
+            "error": str(e)
+        }
+
+async def _run_batch(batch: list, slots: asyncio.Semaphore):
+    """POST one batch and resolve each caller's future with its result"""
+    try:
+        # Batches queued before the circuit opened shouldn't each sit through the full timeout
+        if _breaker.state == CircuitBreaker.OPEN:
+            error = CircuitOpenError("Hugging Face API circuit breaker is open")
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(error)
+            return
+        
+        texts = [text for text, _ in batch]
+        try:
+            results = await _post_batch(texts)
+        except Exception as e:
+            _breaker.record_failure()
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        _breaker.record_success()
+        
+        if len(results) != len(batch):
+            # Results can't be matched to inputs, so don't guess a label for any of them
+            logger.error(f"HF API returned {len(results)} results for {len(batch)} inputs")
+            parsed = [{
+                "label": "unknown document",
+                "confidence": 0.0,
+                "status": "parse_error",
+                "error": f"expected {len(batch)} results, got {len(results)}"
+            } for _ in batch]
+        else:
+            parsed = [_parse_result(result) for result in results]
+        
+        for (_, fut), classification in zip(batch, parsed):
+            if not fut.done():
+                fut.set_result(classification)
+    finally:
+        slots.release()
+
+async def batch_worker():
+    """Drain the queue in batches and send each batch as its own task"""
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(MAX_CONCURRENT_BATCHES)
+    while True:
+        # Wait for a free slot first, so the queue fills up into full batches under load
+        await slots.acquire()
+        try:
+            batch = [await _batch_queue.get()]
+        except BaseException:
+            slots.release()
+            raise
+        deadline = loop.time() + MAX_DELAY
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_batch_queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        task = asyncio.create_task(_run_batch(batch, slots))
+        _batch_requests.add(task)
+        task.add_done_callback(_batch_requests.discard)
+
+async def classify_document(text: str) -> dict:
+    """Classify document using Hugging Face API"""
+    if _session is None:
+        raise RuntimeError("HTTP session not initialized")
+
+    if _batch_queue is None:
+        raise RuntimeError("Batch worker not started")
+    
+    logger.info(f"Text length: {len(text)} characters")
+    
+    # Limit text size to prevent issues with large documents
+    limited_text = text[:5000] if len(text) > 5000 else text
+    
+    key = hashlib.blake2b(limited_text.encode(), digest_size=16).digest()
+    cached = _cache.get(key)
+    if cached is not None:
+        logger.info("Returning cached classification")
+        return cached
+    
+    if not _breaker.allow_request():
+        logger.warning("HF API circuit open, failing fast")
+        raise CircuitOpenError("Hugging Face API circuit breaker is open")
+    
+    # Subscribe to an identical request that is already in flight
+    inflight = _inflight.get(key)
+    if inflight is not None:
+        logger.info("Joining in-flight classification for identical text")
+        return await asyncio.shield(inflight)
+    
+    fut = asyncio.get_running_loop().create_future()
+    _inflight[key] = fut
+    try:
+        await _batch_queue.put((limited_text, fut))
+        # Shielded so a disconnecting caller doesn't cancel the result for its subscribers
+        classification = await asyncio.shield(fut)
+        
+        # Only cache real answers, not parse errors
+        if classification.get("status") == "success":
+            _cache[key] = classification
+        return classification
+    finally:
+        _inflight.pop(key, None)
@@ -1,21 +1,84 @@
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pdf2image import convert_from_bytes
+from fastapi.responses import ORJSONResponse
+from fastapi.concurrency import run_in_threadpool
+import fitz
 import pytesseract
 from PIL import Image
-import io
 import os
+import shutil
+import asyncio
+import tempfile
+import uuid
+import queue
 import logging
-from classifier_service import classify_document
-from spaces_service import store_document
+import multiprocessing
+from functools import partial
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from classifier_service import (
+    classify_document, CircuitOpenError,
+    open_session, close_session, start_batch_worker, stop_batch_worker
+)
+from spaces_service import (
+    store_document, move_document, delete_document, open_client, close_client
+)
+from settings import get_settings
 from tenacity import RetryError
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging; records are queued and written by a listener thread, off the event loop
+_log_queue = queue.SimpleQueue()
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(_log_queue)])
+_log_listener = QueueListener(_log_queue, logging.StreamHandler())
 logger = logging.getLogger(__name__)
 
+def _init_ocr_worker():
+    # Workers have no listener thread draining the queue, so log directly
+    logging.basicConfig(level=logging.INFO, force=True)
+    # Parallelism comes from running pages side by side, so keep each tesseract single-threaded
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+# Pages with less embedded text than this are treated as scans and OCR'd
+MIN_PAGE_TEXT = 20
+# Resolution scanned PDF pages are rendered at for OCR, capped so the long edge fits OCR_MAX_EDGE
+OCR_DPI = 200
+
+# Images are downscaled and binarized before OCR; printed text stays legible well below 12MP
+OCR_MAX_EDGE = 2000
+OCR_THRESHOLD = 150
+# LSTM engine with a single uniform text block is faster than full layout analysis
+TESSERACT_CONFIG = "--oem 1 --psm 6"
+
+# Returned when the HF API is unavailable
+FALLBACK_CLASSIFICATION = {
+    "label": "unclassified document",
+    "confidence": 0.0,
+    "status": "fallback_used"
+}
+
+# Accepted upload types
+_ALLOWED_EXTS = frozenset({'.pdf', '.png', '.jpg', '.jpeg'})
+
+# Uploads land under a unique folder here while classification is still in flight
+PENDING_TYPE = "pending"
+
+# OCR is CPU-bound, so text extraction runs in worker processes off the event loop.
+# Workers x page threads is kept at about one tesseract per core
+OCR_WORKERS = max(1, (os.cpu_count() or 1) // 2)
+OCR_PAGE_THREADS = max(1, (os.cpu_count() or 1) // OCR_WORKERS)
+_ocr_pool: ProcessPoolExecutor | None = None
+
+def new_ocr_pool() -> ProcessPoolExecutor:
+    # forkserver, so workers aren't forked from a process that is already running threads
+    return ProcessPoolExecutor(
+        max_workers=OCR_WORKERS,
+        mp_context=multiprocessing.get_context("forkserver"),
+        initializer=_init_ocr_worker
+    )
+
 # Initialize FastAPI
-app = FastAPI(title="Pregnancy Document Classifier")
+app = FastAPI(title="Pregnancy Document Classifier", default_response_class=ORJSONResponse)
 
 # CORS Configuration
 app.add_middleware(
@@ -25,6 +88,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def startup():
+    global _ocr_pool
+    # Fail fast on missing configuration
+    get_settings()
+    _log_listener.start()
+    _ocr_pool = new_ocr_pool()
+    await open_session()
+    start_batch_worker()
+    await open_client()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await stop_batch_worker()
+    await close_session()
+    await close_client()
+    if _ocr_pool is not None:
+        _ocr_pool.shutdown(wait=False, cancel_futures=True)
+    _log_listener.stop()
+
 @app.get("/")
 async def root():
     return {"message": "Pregnancy Classifier API - Up and running"}
@@ -37,13 +120,6 @@ async def health_check():
 async def test_huggingface():
     """Test endpoint to verify Hugging Face API connection"""
     try:
-        # Check environment variables
-        if not os.getenv("MODEL_ENDPOINT"):
-            return {"status": "error", "message": "MODEL_ENDPOINT environment variable is not set"}
-        
-        if not os.getenv("HF_API_TOKEN"):
-            return {"status": "error", "message": "HF_API_TOKEN environment variable is not set"}
-        
         # Use a simple test text
         test_text = "This is a test for ultrasound report classification."
         
@@ -55,14 +131,21 @@ async def test_huggingface():
                 "status": "success",
                 "message": "Connection to Hugging Face API successful",
                 "classification": classification,
-                "model_endpoint": os.getenv("MODEL_ENDPOINT")
+                "model_endpoint": get_settings().model_endpoint
             }
         except RetryError as e:
             # Handle retry error specifically
             return {
                 "status": "error",
                 "message": "Hugging Face API is currently unavailable after multiple retry attempts",
-                "model_endpoint": os.getenv("MODEL_ENDPOINT"),
+                "model_endpoint": get_settings().model_endpoint,
+                "error_details": str(e)
+            }
+        except CircuitOpenError as e:
+            return {
+                "status": "error",
+                "message": "Hugging Face API is currently unavailable (circuit breaker open)",
+                "model_endpoint": get_settings().model_endpoint,
                 "error_details": str(e)
             }
         
@@ -71,9 +154,45 @@ async def test_huggingface():
         return {
             "status": "error", 
             "message": f"Connection to Hugging Face API failed: {str(e)}",
-            "model_endpoint": os.getenv("MODEL_ENDPOINT")
+            "model_endpoint": get_settings().model_endpoint
         }
 
+async def classify_with_fallback(text: str) -> dict:
+    """Classify text, falling back to an unclassified label if the HF API is unavailable"""
+    try:
+        classification = await classify_document(text)
+        
+        # === ADD LOGGING FOR CLASSIFICATION RESULT ===
+        logger.info(f"Raw classification response: {classification}")
+        # ============================================
+        return classification
+        
+    except (RetryError, CircuitOpenError):
+        # If Hugging Face API is unavailable, use a fallback classification
+        logger.warning("Hugging Face API unavailable, using fallback classification")
+        return dict(FALLBACK_CLASSIFICATION)
+
+async def run_extract_text(path: str, filename: str) -> str:
+    """Run extract_text in the OCR pool, replacing the pool if a worker died"""
+    global _ocr_pool
+    pool = _ocr_pool
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, extract_text, path, filename)
+    except BrokenProcessPool:
+        # A worker was killed (OOM, MuPDF crash); without a new pool every later request would fail
+        if _ocr_pool is pool:
+            logger.error("OCR worker died, replacing the process pool")
+            _ocr_pool = new_ocr_pool()
+            pool.shutdown(wait=False, cancel_futures=True)
+        raise RuntimeError("Text extraction failed: OCR worker crashed")
+
+async def discard_document(patient_id: str, doc_type: str, filename: str):
+    """Best-effort cleanup of a stored file after a failed request"""
+    try:
+        await delete_document(patient_id, doc_type, filename)
+    except Exception as e:
+        logger.warning(f"Failed to clean up {doc_type}/{filename}: {str(e)}")
+
 @app.post("/classify")
 async def classify_endpoint(
     file: UploadFile = File(...),
@@ -81,39 +200,43 @@ async def classify_endpoint(
 ):
     try:
         # 1. Validate file type
-        if not file.filename.lower().endswith(('.pdf', '.png', '.jpg', '.jpeg')):
+        if os.path.splitext(file.filename)[1].lower() not in _ALLOWED_EXTS:
             raise HTTPException(400, detail="Invalid file type. Only PDF/JPEG/PNG allowed")
         
-        # 2. Read and extract text
-        contents = await file.read()
-        extracted_text = extract_text(io.BytesIO(contents), file.filename)
+        # 2. Spool to disk and extract text without holding the upload in memory
+        tmp_path = await run_in_threadpool(spool_to_disk, file.file, file.filename)
+        try:
+            extracted_text = await run_extract_text(tmp_path, file.filename)
+        finally:
+            os.unlink(tmp_path)
         
         # === ADD DEBUG LOGGING HERE ===
-        logger.info(f"Extracted text sample: {extracted_text[:500]}...")  # Log first 500 chars
-        logger.info(f"Sending this text to classifier: {extracted_text}")
+        logger.info(f"Extracted text sample: {extracted_text[:200]}...")  # Log first 200 chars
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Sending this text to classifier: {extracted_text}")
         # ==============================
         
-        # 3. Classify
-        try:
-            classification = await classify_document(extracted_text)
-            
-            # === ADD LOGGING FOR CLASSIFICATION RESULT ===
-            logger.info(f"Raw classification response: {classification}")
-            # ============================================
-            
-        except RetryError:
-            # If Hugging Face API is unavailable, use a fallback classification
-            logger.warning("Hugging Face API unavailable, using fallback classification")
-            classification = {
-                "label": "unclassified document",  # Fallback label
-                "confidence": 0.0,
-                "status": "fallback_used"
-            }
+        # 3. Classify and store in parallel; the file waits under pending/ until the label is known
+        pending_type = f"{PENDING_TYPE}/{uuid.uuid4().hex}"
+        file.file.seek(0)
+        classification, stored = await asyncio.gather(
+            classify_with_fallback(extracted_text),
+            store_document(file.file, patient_id, pending_type, file.filename),
+            return_exceptions=True
+        )
         
-        # 4. Store
-        s3_path = await store_document(contents, patient_id, 
-                                      classification.get('label', 'unclassified'), 
-                                      file.filename)
+        # 4. Move into the folder for its label, never leaving the pending copy behind
+        try:
+            for result in (classification, stored):
+                if isinstance(result, BaseException):
+                    raise result
+            s3_path = await move_document(patient_id, pending_type,
+                                          classification.get('label', 'unclassified'),
+                                          file.filename)
+        except BaseException:
+            if not isinstance(stored, BaseException):
+                await discard_document(patient_id, pending_type, file.filename)
+            raise
         
         return {
             "patient_id": patient_id,
@@ -128,16 +251,61 @@ async def classify_endpoint(
         logger.error(f"Error: {str(e)}")
         raise HTTPException(500, detail=f"Document processing failed: {str(e)}")
 
-def extract_text(file_stream, filename: str) -> str:
+def ocr_image(img: Image.Image) -> str:
+    """Grayscale, downscale and threshold an image, then run Tesseract on it"""
+    img = img.convert("L")
+    w, h = img.size
+    scale = min(1.0, OCR_MAX_EDGE / max(w, h))
+    if scale < 1:
+        img = img.resize((int(w * scale), int(h * scale)), Image.LANCZOS)
+    img = img.point(lambda p: 255 if p > OCR_THRESHOLD else 0)
+    return pytesseract.image_to_string(img, config=TESSERACT_CONFIG)
+
+def ocr_pdf_page(path: str, index: int) -> str:
+    """Render one PDF page and OCR it; opens its own document since MuPDF documents aren't thread-safe"""
+    with fitz.open(path, filetype="pdf") as doc:
+        page = doc[index]
+        # Pick the zoom so ocr_image never has to resample the page (1px slack for rounding)
+        zoom = min(OCR_DPI / 72, (OCR_MAX_EDGE - 1) / max(page.rect.width, page.rect.height))
+        # Render straight to grayscale: a third of the bytes of RGB, same OCR result
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+        img = Image.frombytes("L", (pix.width, pix.height), pix.samples)
+    del pix
+    return ocr_image(img)
+
+def spool_to_disk(fileobj, filename: str) -> str:
+    """Copy an upload to a named temp file in chunks so OCR workers can open it by path"""
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(filename)[1], delete=False) as tmp:
+        try:
+            shutil.copyfileobj(fileobj, tmp)
+        except BaseException:
+            # Disk full or client gone mid-read; don't leave the partial copy behind
+            tmp.close()
+            os.unlink(tmp.name)
+            raise
+        return tmp.name
+
+def extract_text(path: str, filename: str) -> str:
     """Extract text from PDF or image using Tesseract OCR"""
     try:
-        if filename.lower().endswith('.pdf'):
-            images = convert_from_bytes(file_stream.read())
-            text = "\n".join(pytesseract.image_to_string(img) for img in images)
-            logger.info(f"Extracted {len(text)} characters from PDF")
+        if os.path.splitext(filename)[1].lower() == '.pdf':
+            with fitz.open(path, filetype="pdf") as doc:
+                # Use the embedded text layer when there is one, OCR only scanned pages
+                parts = [page.get_text("text") for page in doc]
+            scans = [i for i, page_text in enumerate(parts) if len(page_text.strip()) < MIN_PAGE_TEXT]
+            
+            # Tesseract runs as a subprocess per page, so threads give real parallelism.
+            # Each task renders its own page, so at most OCR_PAGE_THREADS bitmaps exist at once
+            if scans:
+                with ThreadPoolExecutor(max_workers=min(len(scans), OCR_PAGE_THREADS)) as pool:
+                    for i, page_text in zip(scans, pool.map(partial(ocr_pdf_page, path), scans)):
+                        parts[i] = page_text
+            
+            text = "\n".join(parts)
+            logger.info(f"Extracted {len(text)} characters from PDF ({len(scans)}/{len(parts)} pages OCR'd)")
             return text
         else:
-            text = pytesseract.image_to_string(Image.open(file_stream))
+            text = ocr_image(Image.open(path))
             logger.info(f"Extracted {len(text)} characters from image")
             return text
     except Exception as e:
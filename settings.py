@@ -0,0 +1,44 @@
+import os
+from functools import lru_cache
+
+_REQUIRED = [
+    "MODEL_ENDPOINT",
+    "HF_API_TOKEN",
+    "BUCKET_NAME",
+    "SPACES_ENDPOINT",
+    "AWS_ACCESS_KEY_ID",
+    "AWS_SECRET_ACCESS_KEY"
+]
+
+class Settings:
+    """Static service configuration, read from the environment once"""
+
+    def __init__(self):
+        missing = [name for name in _REQUIRED if not os.getenv(name)]
+        if missing:
+            raise RuntimeError(f"Missing required environment variables: {', '.join(missing)}")
+        self.model_endpoint = os.environ["MODEL_ENDPOINT"]
+        self.hf_token = os.environ["HF_API_TOKEN"]
+        self.bucket = os.environ["BUCKET_NAME"]
+        self.spaces_endpoint = os.environ["SPACES_ENDPOINT"]
+        self.spaces_key = os.environ["AWS_ACCESS_KEY_ID"]
+        self.spaces_secret = os.environ["AWS_SECRET_ACCESS_KEY"]
+        self.spaces_url_prefix = f"{self.spaces_endpoint}/{self.bucket}"
+        
+        # Optional tuning
+        compress = os.getenv("HF_COMPRESS_REQUESTS", "false").lower()
+        if compress not in ("true", "false"):
+            raise RuntimeError(f"HF_COMPRESS_REQUESTS must be 'true' or 'false', got {compress!r}")
+        self.compress_requests = compress == "true"
+        
+        ttl = os.getenv("CLASSIFICATION_CACHE_TTL", "3600")
+        try:
+            self.cache_ttl = int(ttl)
+        except ValueError:
+            raise RuntimeError(f"CLASSIFICATION_CACHE_TTL must be an integer number of seconds, got {ttl!r}")
+        if self.cache_ttl <= 0:
+            raise RuntimeError(f"CLASSIFICATION_CACHE_TTL must be positive, got {self.cache_ttl}")
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    return Settings()
\ No newline at end of file
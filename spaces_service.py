@@ -1,28 +1,104 @@
-import boto3
-import os
+import aioboto3
+from contextlib import AsyncExitStack
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
+from settings import get_settings
+
+# Large scans are sent as multipart uploads with parts in flight concurrently.
+# aioboto3 runs the parts as asyncio tasks, so only the size/concurrency/queue fields apply.
+# The read-ahead queue is capped at max_concurrency parts (default 100), so an upload
+# buffers ~64 MiB rather than most of the file
+_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=8,
+    max_io_queue=8
+)
+
+# Shared S3 client, opened on app startup so it is not rebuilt per upload
+_client = None
+_exit_stack: AsyncExitStack | None = None
+
+async def open_client():
+    """Create the shared aioboto3 client used for Spaces uploads"""
+    global _client, _exit_stack
+    if _client is None:
+        settings = get_settings()
+        _exit_stack = AsyncExitStack()
+        _client = await _exit_stack.enter_async_context(
+            aioboto3.Session().client(
+                's3',
+                endpoint_url=settings.spaces_endpoint,
+                aws_access_key_id=settings.spaces_key,
+                aws_secret_access_key=settings.spaces_secret
+            )
+        )
+
+async def close_client():
+    """Close the shared aioboto3 client"""
+    global _client, _exit_stack
+    if _exit_stack is not None:
+        await _exit_stack.aclose()
+        _client = None
+        _exit_stack = None
 
 def get_spaces_client():
-    return boto3.client(
-        's3',
-        endpoint_url=os.getenv('SPACES_ENDPOINT'),
-        aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-        aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
-    )
-
-async def store_document(content: bytes, patient_id: str, doc_type: str, filename: str) -> str:
-    """Store file in DigitalOcean Spaces with organized structure"""
-    client = get_spaces_client()
+    if _client is None:
+        raise RuntimeError("Spaces client not initialized")
+    return _client
+
+def document_key(patient_id: str, doc_type: str, filename: str) -> str:
     safe_type = doc_type.replace(" ", "_").lower()
-    key = f"patients/{patient_id}/{safe_type}/{filename}"
+    return f"patients/{patient_id}/{safe_type}/{filename}"
+
+async def store_document(fileobj, patient_id: str, doc_type: str, filename: str) -> str:
+    """Store file in DigitalOcean Spaces with organized structure, streaming from fileobj"""
+    client = get_spaces_client()
+    settings = get_settings()
+    key = document_key(patient_id, doc_type, filename)
     
     try:
-        client.put_object(
-            Bucket=os.getenv('BUCKET_NAME'),
+        # aioboto3 reads the sync spooled file in chunk-sized reads on the event loop.
+        # Accepted: it's local memory/disk IO, negligible next to the network upload
+        await client.upload_fileobj(
+            fileobj,
+            Bucket=settings.bucket,
             Key=key,
-            Body=content,
-            ACL='private'  # Change to 'public-read' if needed
+            ExtraArgs={'ACL': 'private'},  # Change to 'public-read' if needed
+            Config=_TRANSFER_CONFIG
         )
-        return f"{os.getenv('SPACES_ENDPOINT')}/{os.getenv('BUCKET_NAME')}/{key}"
+        return f"{settings.spaces_url_prefix}/{key}"
+    except (ClientError, S3UploadFailedError) as e:
+        raise RuntimeError(f"Spaces upload failed: {str(e)}")
+
+async def move_document(patient_id: str, from_type: str, to_type: str, filename: str) -> str:
+    """Move a stored file to another document type folder (server-side copy + delete)"""
+    client = get_spaces_client()
+    settings = get_settings()
+    src_key = document_key(patient_id, from_type, filename)
+    dst_key = document_key(patient_id, to_type, filename)
+    
+    try:
+        if src_key != dst_key:
+            await client.copy_object(
+                Bucket=settings.bucket,
+                Key=dst_key,
+                CopySource={'Bucket': settings.bucket, 'Key': src_key},
+                ACL='private'
+            )
+            await client.delete_object(Bucket=settings.bucket, Key=src_key)
+        return f"{settings.spaces_url_prefix}/{dst_key}"
+    except ClientError as e:
+        raise RuntimeError(f"Spaces move failed: {str(e)}")
+
+async def delete_document(patient_id: str, doc_type: str, filename: str):
+    """Delete a stored file"""
+    client = get_spaces_client()
+    settings = get_settings()
+    key = document_key(patient_id, doc_type, filename)
+    
+    try:
+        await client.delete_object(Bucket=settings.bucket, Key=key)
     except ClientError as e:
-        raise RuntimeError(f"Spaces upload failed: {str(e)}")
\ No newline at end of file
+        raise RuntimeError(f"Spaces delete failed: {str(e)}")
\ No newline at end of file